@@ -0,0 +1,7 @@
+-- Backs the bounded burst hydration query in realtime_fraud_server.py.
+-- Run once, outside a transaction (CONCURRENTLY can't run inside one):
+--   psql "$SUPABASE_URL" -f migrations/idx_orders_date_time.sql
+-- If a build is interrupted it leaves an INVALID index that IF NOT EXISTS
+-- would skip; drop it first with DROP INDEX CONCURRENTLY idx_orders_date_time.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_date_time
+ON shopify_orders_marketing (date_time DESC);
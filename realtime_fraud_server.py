@@ -1,10 +1,20 @@
 from fastapi import FastAPI, Request, Header, HTTPException
-import psycopg2, os, ipaddress, hmac, hashlib, base64, requests
-import geoip2.database
-from urllib.parse import urlparse, parse_qs
+from fastapi.responses import ORJSONResponse
+import asyncpg, os, io, ssl, signal, ipaddress, hmac, hashlib, base64, requests, asyncio, logging
+import geoip2.database, orjson, functools, time, re
+try:
+    import ahocorasick
+except ImportError:   # pyahocorasick is optional, regex fallback below
+    ahocorasick = None
+from collections import deque, namedtuple
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse, unquote_plus
 from datetime import datetime
 
 # ───────── CONFIG ─────────
+# must be a direct or session-mode connection (Supabase port 5432): ingestion keeps
+# a temp table, a PREPARE, asyncpg's statement cache and an advisory lock per session,
+# none of which survive the transaction-mode pooler on port 6543
 SUPABASE_URL   = os.environ["SUPABASE_URL"]
 SHOPIFY_SECRET = os.environ["SHOPIFY_SECRET"]
 CITY_URL = os.environ["GEOIP_CITY_URL"]
@@ -13,16 +23,56 @@ ASN_URL  = os.environ["GEOIP_ASN_URL"]
 CITY_DB = "GeoLite2-City.mmdb"
 ASN_DB  = "GeoLite2-ASN.mmdb"
 
+FLUSH_MAX_ROWS = 5000
+FLUSH_INTERVAL = 0.25   # seconds
+FLUSH_WORKERS  = 4      # concurrent flushes, each on its own pooled connection
+QUEUE_MAX_ROWS = 50_000 # webhooks get 503 (Shopify retries) once this many rows are pending
+FLUSH_BACKOFF_MIN = 0.5   # seconds, doubled per failed attempt
+FLUSH_BACKOFF_MAX = 30
+SHUTDOWN_TIMEOUT  = 30    # seconds to drain on shutdown before giving up on the backlog
+
+MAX_BODY_BYTES       = 512_000     # rejected with 413 before HMAC / JSON work
+VERIFY_OFFLOAD_BYTES = 64 * 1024   # hash bigger bodies off the event loop
+
+# seen IP/phone and burst state are in-process, so the limit is only global
+# with exactly one worker; startup enforces that with a Postgres advisory lock
+BURST_WINDOW = 120      # seconds
+BURST_LIMIT  = 12
+SINGLETON_WAIT = 60     # seconds a new instance waits for the old one to exit
+SINGLETON_HEARTBEAT = 10  # seconds between liveness checks on the lock connection
+
 TELCOS    = ["jio","airtel","vodafone","idea","bsnl","tata"]
 PLATFORMS = ["meta","facebook","google","whatsapp","cloudflare","amazon","aws"]
+SOCIAL_UTMS = frozenset(["facebook", "instagram"])
+
+# one C-level scan per keyword list instead of a Python loop of `in` checks
+TELCO_RE = re.compile("|".join(map(re.escape, TELCOS)))
+PLAT_RE  = re.compile("|".join(map(re.escape, PLATFORMS)))
+
+# with pyahocorasick, one pass over the ASN org finds both telco and platform hits
+ORG_AUTOMATON = None
+if ahocorasick:
+    ORG_AUTOMATON = ahocorasick.Automaton()
+    for w in TELCOS:    ORG_AUTOMATON.add_word(w, "T")
+    for w in PLATFORMS: ORG_AUTOMATON.add_word(w, "P")
+    ORG_AUTOMATON.make_automaton()
 
 # ───────── DOWNLOAD GEOIP ─────────
 def download(url, path):
     if not os.path.exists(path):
         r = requests.get(url, timeout=60)
         r.raise_for_status()
-        with open(path, "wb") as f:
-            f.write(r.content)
+        # write + rename so an instance starting alongside another (rolling deploy)
+        # never opens a half-written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(r.content)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
 
 download(CITY_URL, CITY_DB)
 download(ASN_URL, ASN_DB)
@@ -30,57 +80,213 @@ download(ASN_URL, ASN_DB)
 city_reader = geoip2.database.Reader(CITY_DB)
 asn_reader  = geoip2.database.Reader(ASN_DB)
 
-app = FastAPI()
+log = logging.getLogger("fraud")
 
 # ───────── DATABASE ─────────
-db = psycopg2.connect(SUPABASE_URL, sslmode="require")
-db.autocommit = True
-cur = db.cursor()
+pool = None   # asyncpg pool, opened on startup
 
 # ───────── IDEMPOTENT INSERT (IMPORTANT FIX) ─────────
-INSERT_SQL = """
-INSERT INTO shopify_orders_marketing (
-row_id,date,date_time,order_id,order_name,
-customer_name,phone,address1,address2,city,state,zip,country,
-product_id,variant_id,product_name,variant_name,vendor,price,quantity,weight,
-utm_source,utm_medium,utm_campaign,utm_content,utm_term,utm_id,full_url,ip_address,
-store_name,location_match,ip_checked,fraud_bucket,risk_score
-) VALUES (
-%(row_id)s,%(date)s,%(date_time)s,%(order_id)s,%(order_name)s,
-%(customer_name)s,%(phone)s,%(address1)s,%(address2)s,%(city)s,%(state)s,%(zip)s,%(country)s,
-%(product_id)s,%(variant_id)s,%(product_name)s,%(variant_name)s,%(vendor)s,%(price)s,%(quantity)s,%(weight)s,
-%(utm_source)s,%(utm_medium)s,%(utm_campaign)s,%(utm_content)s,%(utm_term)s,%(utm_id)s,%(full_url)s,%(ip_address)s,
-%(store_name)s,%(location_match)s,%(ip_checked)s,%(fraud_bucket)s,%(risk_score)s
+COLS = (
+    "row_id","date","date_time","order_id","order_name",
+    "customer_name","phone","address1","address2","city","state","zip","country",
+    "product_id","variant_id","product_name","variant_name","vendor","price","quantity","weight",
+    "utm_source","utm_medium","utm_campaign","utm_content","utm_term","utm_id","full_url","ip_address",
+    "store_name","location_match","ip_checked","fraud_bucket","risk_score"
 )
+
+# fixed-column row; it is already a tuple in COLS order, so it goes straight to COPY
+Row = namedtuple("Row", COLS)
+
+# rows are COPY'd into a per-connection temp table, then merged so ON CONFLICT still applies
+STAGE_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS shopify_orders_stage
+(LIKE shopify_orders_marketing INCLUDING DEFAULTS)
+ON COMMIT DELETE ROWS;
+"""
+
+# parsed + planned once per connection, then EXECUTE'd per flush; ORDER BY row_id
+# makes concurrent merges of overlapping batches take row locks in the same order
+PREPARE_SQL = f"""
+PREPARE shop_merge AS
+INSERT INTO shopify_orders_marketing ({",".join(COLS)})
+SELECT {",".join(COLS)} FROM shopify_orders_stage
+ORDER BY row_id
 ON CONFLICT (row_id) DO NOTHING;
 """
 
+# ───────── BULK INGEST ─────────
+queue = asyncio.Queue(maxsize=QUEUE_MAX_ROWS)
+
+# only SQLSTATE class 22 / 23 is blamed on the rows themselves; anything else
+# (outage, read-only db, permissions, bugs) is retried, and the QUEUE_MAX_ROWS
+# 503 bounds the backlog while it lasts
+DATA_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+unflushed = 0   # rows acknowledged to Shopify but not yet written or dropped
+
+def copy_field(v):
+    if v is None:
+        return "\\N"
+    # Postgres text can't hold NUL at all, so it is dropped rather than failing the batch
+    return (str(v).replace("\x00", "").replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+async def prepare(conn):
+    await conn.execute(STAGE_SQL)
+    await conn.execute(PREPARE_SQL)
+
+async def copy_rows(rows):
+    # text-format COPY lets the server coerce values, same as the old literal binding
+    buf = io.BytesIO("".join(
+        "\t".join(copy_field(v) for v in r) + "\n" for r in rows
+    ).encode())
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_to_table(
+                "shopify_orders_stage", source=buf, columns=COLS, format="text"
+            )
+            await conn.execute("EXECUTE shop_merge")
+
+async def flush(rows):
+    global unflushed
+    delay = FLUSH_BACKOFF_MIN
+    while True:
+        try:
+            await copy_rows(rows)
+            unflushed -= len(rows)
+            return
+        except DATA_ERRORS:
+            if len(rows) == 1:
+                log.exception("dropping row %s", rows[0].row_id)
+                unflushed -= 1
+                return
+        except Exception:
+            log.exception("flush of %d rows failed, retrying in %.1fs", len(rows), delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, FLUSH_BACKOFF_MAX)
+            continue
+        break
+    # bisect so one bad row only costs itself, not the rest of the batch
+    mid = len(rows) // 2
+    await flush(rows[:mid])
+    await flush(rows[mid:])
+
+# one collector cuts batches so an order's rows stay together; FLUSH_WORKERS
+# workers only run the COPYs, in parallel when batches back up under load
+STOP = object()
+batches = asyncio.Queue(maxsize=FLUSH_WORKERS)
+
+async def collector():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await queue.get()
+        if row is STOP:
+            break
+        rows = [row]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(rows) < FLUSH_MAX_ROWS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is STOP:
+                stopping = True
+                break
+            rows.append(row)
+        await batches.put(rows)
+    for _ in range(FLUSH_WORKERS):
+        await batches.put(STOP)
+
+async def flush_worker():
+    while True:
+        rows = await batches.get()
+        if rows is STOP:
+            return
+        await flush(rows)
+
+# ───────── APP ─────────
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    if urlparse(SUPABASE_URL).port == 6543:
+        raise RuntimeError("SUPABASE_URL points at the transaction pooler; use a direct or session-mode connection")
+    log_openssl()
+    singleton = await acquire_singleton()
+    watchdog = asyncio.create_task(watch_singleton(singleton))
+    pool = await asyncpg.create_pool(
+        SUPABASE_URL, min_size=FLUSH_WORKERS, max_size=32, ssl="require", init=prepare
+    )
+    await hydrate()
+    flushers = [asyncio.create_task(collector())] + [
+        asyncio.create_task(flush_worker()) for _ in range(FLUSH_WORKERS)
+    ]
+
+    yield
+
+    watchdog.cancel()
+    singleton.remove_termination_listener(lost_singleton)
+
+    # no cancel: the collector drains everything queued ahead of STOP and the
+    # workers finish their in-flight COPYs before exiting, unless the db stays
+    # down past SHUTDOWN_TIMEOUT
+    async def drain():
+        await queue.put(STOP)
+        await asyncio.gather(*flushers)
+    try:
+        await asyncio.wait_for(drain(), SHUTDOWN_TIMEOUT)
+        await pool.close()
+        await singleton.close()
+    except asyncio.TimeoutError:
+        log.error("shutdown timed out; %d acknowledged rows were not written", unflushed)
+        pool.terminate()
+        singleton.terminate()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
 # ───────── SHOPIFY HMAC ─────────
+SECRET_KEY = SHOPIFY_SECRET.encode()
+# keyed once; copy() reuses the ipad/opad state instead of re-hashing the key block
+HMAC_BASE = hmac.new(SECRET_KEY, digestmod=hashlib.sha256)
+
+def log_openssl():
+    log.info("HMAC backend: %s; hashlib algorithms: %s",
+             ssl.OPENSSL_VERSION, ", ".join(sorted(hashlib.algorithms_available)))
+
 def verify(data, hmac_header):
     if not hmac_header:
         return False
-    digest = hmac.new(
-        SHOPIFY_SECRET.encode(),
-        data,
-        hashlib.sha256
-    ).digest()
-    return hmac.compare_digest(
-        base64.b64encode(digest).decode(),
-        hmac_header
-    )
+    m = HMAC_BASE.copy()
+    m.update(data)
+    digest = m.digest()
+    try:
+        supplied = base64.b64decode(hmac_header, validate=True)
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, supplied)
 
 # ───────── HELPERS ─────────
 def clean(x):
     return str(x).strip() if x else None
 
+NON_DIGIT = re.compile(r"\D")
+
 def digits(x):
-    return "".join(c for c in str(x) if c.isdigit()) if x else None
+    return NON_DIGIT.sub("", str(x)) if x else None
 
 def extract_utms(url):
     if not url:
         return {}
-    q = urlparse(url).query
-    return {k: v[0] for k, v in parse_qs(q).items() if k.startswith("utm_")}
+    out = {}
+    # single pass; only utm_ values get unquoted. blanks skipped, first wins (as parse_qs)
+    for part in urlparse(url).query.split("&"):
+        k, _, v = part.partition("=")
+        if v and k.startswith("utm_") and k not in out:
+            out[k] = unquote_plus(v)
+    return out
 
 def parse_notes(attrs):
     out = {}
@@ -92,55 +298,128 @@ def parse_notes(attrs):
     return out
 
 # ───────── GEO ─────────
-def geo(ip):
+# misses (private / malformed IPs) are cached too, as None
+@functools.lru_cache(maxsize=131072)
+def _geo_cached(ip):
     try:
         ipaddress.ip_address(ip)
         c = city_reader.city(ip)
         a = asn_reader.asn(ip)
-        return {
-            "country": c.country.name,
-            "state": c.subdivisions.most_specific.name,
-            "org": (a.autonomous_system_organization or "").lower()
-        }
+        return (
+            c.country.name,
+            c.subdivisions.most_specific.name,
+            (a.autonomous_system_organization or "").lower()
+        )
     except Exception:
         return None
 
+def geo(ip):
+    g = _geo_cached(ip)
+    if g is None:
+        return None
+    return {"country": g[0], "state": g[1], "org": g[2]}
+
 # ───────── FRAUD BRAIN ─────────
-def seen_before(field, value):
-    if not value:
-        return False
-    cur.execute(
-        f"SELECT 1 FROM shopify_orders_marketing WHERE {field}=%s LIMIT 1",
-        (value,)
-    )
-    return cur.fetchone() is not None
+# dedup / burst state lives in memory, hydrated from the table on startup
+seen_ips    = set()
+seen_phones = set()
+# epoch seconds of recently ingested rows; burst() only needs to see the
+# (BURST_LIMIT+1)th newest, so older entries can fall off the left
+recent      = deque(maxlen=BURST_LIMIT + 1)
+
+SINGLETON_LOCK_SQL = "SELECT pg_try_advisory_lock(hashtext('shopify_fraud_engine'))"
+
+# held on its own connection for the life of the process; a second worker or
+# host waits here, so a rolling deploy hands over once the old instance exits
+async def acquire_singleton():
+    conn = await asyncpg.connect(SUPABASE_URL, ssl="require")
+    deadline = time.monotonic() + SINGLETON_WAIT
+    while not await conn.fetchval(SINGLETON_LOCK_SQL):
+        if time.monotonic() > deadline:
+            await conn.close()
+            raise RuntimeError("another fraud server instance is running; run exactly one worker")
+        await asyncio.sleep(1)
+    conn.add_termination_listener(lost_singleton)
+    return conn
+
+# the lock dies with its connection and another instance may take it, so stop
+# serving; the supervisor restarts us, which re-takes the lock and re-hydrates
+def lost_singleton(conn):
+    log.error("singleton lock connection lost; shutting down")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+# an idle connection can die silently (no FIN); a failed ping terminates it,
+# which fires lost_singleton
+async def watch_singleton(conn):
+    while True:
+        await asyncio.sleep(SINGLETON_HEARTBEAT)
+        try:
+            await conn.fetchval("SELECT 1", timeout=SINGLETON_HEARTBEAT)
+        except Exception:
+            conn.terminate()
+            return
+
+# the burst query is an index range scan once migrations/idx_orders_date_time.sql is applied
+async def hydrate():
+    rows = await pool.fetch("SELECT DISTINCT ip_address FROM shopify_orders_marketing WHERE ip_address IS NOT NULL")
+    seen_ips.update(r[0] for r in rows)
+    rows = await pool.fetch("SELECT DISTINCT phone FROM shopify_orders_marketing WHERE phone IS NOT NULL")
+    seen_phones.update(r[0] for r in rows)
+    rows = await pool.fetch("""
+        SELECT EXTRACT(EPOCH FROM date_time) FROM shopify_orders_marketing
+        WHERE date_time > NOW() - interval '2 minutes'
+        ORDER BY date_time DESC
+        LIMIT $1
+    """, BURST_LIMIT + 1)
+    recent.extend(float(r[0]) for r in reversed(rows))
+
+def remember(row):
+    if row.ip_address: seen_ips.add(row.ip_address)
+    if row.phone: seen_phones.add(row.phone)
+    # ingest time, not date_time, on purpose: a re-delivered order counts toward
+    # a burst again, since a replay storm is itself traffic worth flagging
+    recent.append(time.time())
+
+def seen_before(seen, value):
+    return bool(value) and value in seen
 
 def burst():
-    cur.execute("""
-        SELECT COUNT(*) FROM shopify_orders_marketing
-        WHERE date_time > NOW() - interval '2 minutes'
-    """)
-    return cur.fetchone()[0] > 12
+    cutoff = time.time() - BURST_WINDOW
+    while recent and recent[0] <= cutoff:
+        recent.popleft()
+    return len(recent) > BURST_LIMIT
 
+# expects addr already lowercased by the caller
 def address_entropy(addr):
-    if not addr:
-        return 0
-    words = addr.lower().split()
-    return len(set(words)) / max(len(words), 1)
+    words = addr.split() if addr else None
+    return len(set(words)) / len(words) if words else 0.0
+
+# there are far fewer ASN orgs than IPs, so this is nearly always a cache hit
+@functools.lru_cache(maxsize=16384)
+def org_kinds(org):
+    if ORG_AUTOMATON is None:
+        return frozenset(k for k, r in (("T", TELCO_RE), ("P", PLAT_RE)) if r.search(org))
+    kinds = set()
+    for _, kind in ORG_AUTOMATON.iter(org):
+        kinds.add(kind)
+        if len(kinds) == 2:
+            break
+    return frozenset(kinds)
 
 def classify(note, utm, ipg):
     risk = 0
     org = ipg.get("org", "") if ipg else ""
+    kinds = org_kinds(org) if org else ()
 
-    if any(t in org for t in TELCOS): risk += 10
-    if any(p in org for p in PLATFORMS): risk += 15
-    if utm in ["facebook", "instagram"]: risk += 15
+    if "T" in kinds: risk += 10
+    if "P" in kinds: risk += 15
+    if utm in SOCIAL_UTMS: risk += 15
 
-    if seen_before("ip_address", note.get("ip_address")): risk += 25
-    if seen_before("phone", note.get("phone")): risk += 35
+    if seen_before(seen_ips, note.get("ip_address")): risk += 25
+    if seen_before(seen_phones, note.get("phone")): risk += 35
     if burst(): risk += 30
 
-    addr = (note.get("address1") or "") + " " + (note.get("address2") or "")
+    addr = f'{note.get("address1") or ""} {note.get("address2") or ""}'.lower()
     if address_entropy(addr) < 0.5: risk += 20
 
     if note.get("country") and ipg and note["country"].lower() != (ipg["country"] or "").lower():
@@ -152,72 +431,95 @@ def classify(note, utm, ipg):
     return "CLEAN", risk
 
 # ───────── FLATTENER ─────────
-def build_row(order, li, store):
-    note = parse_notes(order.get("note_attributes", []))
-    landing = order.get("landing_site_ref") or order.get("landing_site")
-    utms = extract_utms(landing)
-
-    return {
-        "row_id": f"{store}_{order['id']}_{li['product_id']}_{li['variant_id']}",
-        "date": order["created_at"][:10],
-        "date_time": order["created_at"],
-        "order_id": order["id"],
-        "order_name": order.get("name"),
-        "customer_name": note.get("full_name"),
-        "phone": digits(note.get("phone")),
-        "address1": note.get("house_no._&_colony/apartment"),
-        "address2": note.get("nearby_school,_hospital,_shop"),
-        "city": note.get("city"),
-        "state": note.get("state"),
-        "zip": digits(note.get("zip_code")),
-        "country": note.get("country"),
-        "product_id": li.get("product_id"),
-        "variant_id": li.get("variant_id"),
-        "product_name": li.get("title"),
-        "variant_name": li.get("variant_title"),
-        "vendor": li.get("vendor"),
-        "price": li.get("price"),
-        "quantity": li.get("quantity"),
-        "weight": li.get("grams"),
-        "utm_source": note.get("utm_source") or utms.get("utm_source"),
-        "utm_medium": note.get("utm_medium") or utms.get("utm_medium"),
-        "utm_campaign": note.get("utm_campaign") or utms.get("utm_campaign"),
-        "utm_content": note.get("utm_content") or utms.get("utm_content"),
-        "utm_term": note.get("utm_term") or utms.get("utm_term"),
-        "utm_id": note.get("utm_id"),
-        "full_url": note.get("full_url") or landing,
-        "ip_address": note.get("ip_address"),
-        "store_name": store
-    }
+# note / utms / landing / row_id prefix are per order; the webhook computes them once
+def build_row(order, li, store, note, utms, landing, prefix, ip_checked, bucket, score):
+    return Row(
+        row_id=f"{prefix}{li['product_id']}_{li['variant_id']}",
+        date=order["created_at"][:10],
+        date_time=order["created_at"],
+        order_id=order["id"],
+        order_name=order.get("name"),
+        customer_name=note.get("full_name"),
+        phone=digits(note.get("phone")),
+        address1=note.get("house_no._&_colony/apartment"),
+        address2=note.get("nearby_school,_hospital,_shop"),
+        city=note.get("city"),
+        state=note.get("state"),
+        zip=digits(note.get("zip_code")),
+        country=note.get("country"),
+        product_id=li.get("product_id"),
+        variant_id=li.get("variant_id"),
+        product_name=li.get("title"),
+        variant_name=li.get("variant_title"),
+        vendor=li.get("vendor"),
+        price=li.get("price"),
+        quantity=li.get("quantity"),
+        weight=li.get("grams"),
+        utm_source=note.get("utm_source") or utms.get("utm_source"),
+        utm_medium=note.get("utm_medium") or utms.get("utm_medium"),
+        utm_campaign=note.get("utm_campaign") or utms.get("utm_campaign"),
+        utm_content=note.get("utm_content") or utms.get("utm_content"),
+        utm_term=note.get("utm_term") or utms.get("utm_term"),
+        utm_id=note.get("utm_id"),
+        full_url=note.get("full_url") or landing,
+        ip_address=note.get("ip_address"),
+        store_name=store,
+        location_match=False,
+        ip_checked=ip_checked,
+        fraud_bucket=bucket,
+        risk_score=score
+    )
 
 # ───────── WEBHOOK ─────────
+async def read_body(req):
+    cl = req.headers.get("content-length")
+    if cl and cl.isdigit() and int(cl) > MAX_BODY_BYTES:
+        raise HTTPException(413, "Body too large")
+    # chunked / lying content-length: stop reading as soon as the cap is crossed
+    chunks, size = [], 0
+    async for chunk in req.stream():
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPException(413, "Body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
 @app.post("/shopify")
 async def shopify(
     req: Request,
     x_shopify_hmac_sha256: str = Header(None),
     x_shopify_shop_domain: str = Header(None)
 ):
-    raw = await req.body()
-    if not verify(raw, x_shopify_hmac_sha256):
+    global unflushed
+    raw = await read_body(req)
+    if len(raw) > VERIFY_OFFLOAD_BYTES:
+        ok = await asyncio.to_thread(verify, raw, x_shopify_hmac_sha256)
+    else:
+        ok = verify(raw, x_shopify_hmac_sha256)
+    if not ok:
         raise HTTPException(401, "Bad HMAC")
 
     store = x_shopify_shop_domain or "unknown"
-    order = await req.json()
+    order = orjson.loads(raw)
+
+    # all of an order's rows are queued or none are
+    if queue.maxsize - queue.qsize() < len(order["line_items"]):
+        raise HTTPException(503, "Ingest backlog full")
 
     note = parse_notes(order.get("note_attributes", []))
     landing = order.get("landing_site_ref") or order.get("landing_site")
-    utm = note.get("utm_source") or extract_utms(landing).get("utm_source")
+    utms = extract_utms(landing)
+    utm = note.get("utm_source") or utms.get("utm_source")
     ip  = note.get("ip_address")
+    prefix = f"{store}_{order['id']}_"
 
     ipg = geo(ip)
     bucket, score = classify(note, utm, ipg)
 
     for li in order["line_items"]:
-        row = build_row(order, li, store)
-        row["location_match"] = False
-        row["ip_checked"] = True if ipg else False
-        row["fraud_bucket"] = bucket
-        row["risk_score"] = score
-        cur.execute(INSERT_SQL, row)
+        row = build_row(order, li, store, note, utms, landing, prefix, ipg is not None, bucket, score)
+        queue.put_nowait(row)
+        remember(row)
+    unflushed += len(order["line_items"])
 
     return {"status": "ok"}